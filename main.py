@@ -1,13 +1,180 @@
+import asyncio
+import functools
+import hashlib
+import logging
 import os
+import sys
+import time
+from contextlib import asynccontextmanager
 from typing import List, Optional, Literal, Any, Dict
-from fastapi import FastAPI, HTTPException
+
+import anyio.to_thread
+import orjson
+from bson import ObjectId
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from pymongo.errors import BulkWriteError, WriteError
 
-from database import create_document, get_documents, db
+from database import create_document, create_documents, db
 from schemas import Quote
 
-app = FastAPI(title="Insurance Comparison API", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+# Quote inserts issued while another write is in flight are batched into one insert_many
+_QUOTE_BATCH_SIZE = 100
+_QUOTE_BATCH_WINDOW = 0.02  # seconds
+
+_quote_queue: Optional[asyncio.Queue] = None
+_quote_write_done: Optional[asyncio.Event] = None
+_quote_writes_in_flight = 0
+
+
+async def _persist_quote(doc: dict) -> str:
+    """Insert a quote document, joining the current batch when the database is busy"""
+    global _quote_writes_in_flight
+    if _quote_queue is None or (_quote_writes_in_flight == 0 and _quote_queue.empty()):
+        # Fast path: nothing else is writing, so don't pay the batching window
+        _quote_writes_in_flight += 1
+        try:
+            return await create_document("quote", doc)
+        finally:
+            _quote_writes_in_flight -= 1
+            if _quote_write_done is not None:
+                _quote_write_done.set()
+
+    future = asyncio.get_running_loop().create_future()
+    await _quote_queue.put((doc, future))
+    return await future
+
+
+async def _gather_quote_batch(batch: list):
+    """Add queued quotes to the batch until it is full, the window closes,
+    or no other write is left in flight to wait behind
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + _QUOTE_BATCH_WINDOW
+    while len(batch) < _QUOTE_BATCH_SIZE:
+        if not _quote_queue.empty():
+            batch.append(_quote_queue.get_nowait())
+            continue
+        timeout = deadline - loop.time()
+        # The batch itself counts as one write in flight
+        if timeout <= 0 or _quote_writes_in_flight <= 1:
+            return
+
+        _quote_write_done.clear()
+        getter = asyncio.ensure_future(_quote_queue.get())
+        write_done = asyncio.ensure_future(_quote_write_done.wait())
+        done, pending = await asyncio.wait(
+            {getter, write_done}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        if getter in done:
+            batch.append(getter.result())
+
+
+async def _quote_writer():
+    """Drain queued quotes in batches of up to _QUOTE_BATCH_SIZE or _QUOTE_BATCH_WINDOW"""
+    global _quote_writes_in_flight
+    while True:
+        batch = [await _quote_queue.get()]
+        # Count the batch as in flight while it gathers so new quotes join it
+        _quote_writes_in_flight += 1
+        try:
+            await _gather_quote_batch(batch)
+            # Assign ids up front so they are known even when part of the batch fails
+            for doc, _ in batch:
+                doc["_id"] = ObjectId()
+            await create_documents("quote", [doc for doc, _ in batch])
+        except BulkWriteError as e:
+            # Unordered insert: everything not listed in writeErrors was written
+            failed = {err["index"]: err for err in e.details.get("writeErrors", [])}
+            for index, (doc, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if e.details.get("writeConcernErrors"):
+                    future.set_exception(e)
+                elif index in failed:
+                    err = failed[index]
+                    future.set_exception(WriteError(err.get("errmsg"), err.get("code"), err))
+                else:
+                    future.set_result(str(doc["_id"]))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for doc, future in batch:
+                if not future.done():
+                    future.set_result(str(doc["_id"]))
+        finally:
+            _quote_writes_in_flight -= 1
+
+
+async def _create_quote_indexes():
+    # Serves list_quotes filtered by quote_type, newest first (idempotent)
+    try:
+        await db.quote.create_index([("quote_type", 1), ("_id", -1)])
+    except Exception as e:
+        logger.warning("Could not create quote index: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _quote_queue, _quote_write_done
+    # Headroom for future sync routes or dependencies: raise anyio's default 40-slot thread
+    # pool. Every current route is async and Motor uses its own executor, so this has no
+    # effect today
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = int(os.getenv("FASTAPI_THREADS", 200))
+
+    writer = None
+    index_task = None
+    if db is not None:
+        # Built in the background so startup doesn't wait on an unreachable database
+        index_task = asyncio.create_task(_create_quote_indexes())
+        _quote_queue = asyncio.Queue()
+        _quote_write_done = asyncio.Event()
+        writer = asyncio.create_task(_quote_writer())
+    yield
+    if index_task is not None and not index_task.done():
+        index_task.cancel()
+    if writer is not None:
+        writer.cancel()
+        try:
+            await writer
+        except asyncio.CancelledError:
+            pass
+        _quote_queue = None
+        _quote_write_done = None
+
+
+def _orjson_default(obj: Any) -> Any:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson-encoded response that also serializes BSON ObjectIds"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default)
+
+
+app = FastAPI(
+    title="Insurance Comparison API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=MongoJSONResponse,
+)
+
+# Compress larger JSON bodies (quote listings repeat the same keys per document)
+app.add_middleware(GZipMiddleware, minimum_size=512)
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,6 +201,91 @@ class QuoteRequest(BaseModel):
     square_feet: Optional[int] = Field(None, ge=100)
     security_system: Optional[bool] = None
 
+    @field_validator("zip_code")
+    @classmethod
+    def _check_zip_code(cls, v: str) -> str:
+        # isascii() rules out non-ASCII digits that str.isdigit() would accept
+        if len(v) != 5 or not (v.isascii() and v.isdigit()):
+            raise ValueError("zip_code must be a 5-digit US ZIP code")
+        return v
+
+
+# (price factor in permille, name, rating, features, cta) for each simulated carrier
+_CARRIER_TEMPLATES = (
+    (950, "BlueShield Mutual", 4.7, ("24/7 support", "Bundle discount", "Fast claims"), "Get Started"),
+    (1020, "NorthStar Insurance", 4.5, ("Accident forgiveness", "Roadside (auto)", "Smart home (home)"), "Select"),
+    (880, "Aurora Coverage Co.", 4.3, ("Low deductible options", "Local agents", "Online portal"), "View Details"),
+)
+
+
+def _load_zip_factors() -> Dict[str, int]:
+    """Load regional risk modifiers keyed by 5-digit ZIP, converted to permille.
+    The JSON file maps ZIP codes to fractional modifiers, e.g. {"10001": 0.12}.
+    A missing file means no regional adjustment.
+    """
+    path = os.getenv("ZIP_FACTORS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "zip_factors.json"))
+    try:
+        with open(path, "rb") as f:
+            factors = orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    return {str(zip_code)[:5]: round(float(factor) * 1000) for zip_code, factor in factors.items()}
+
+
+_ZIP_FACTOR_PERMILLE = _load_zip_factors()
+
+
+@functools.lru_cache(maxsize=4096)
+def _price(
+    quote_type: str,
+    young_driver: bool,
+    old_vehicle: bool,
+    accidents: int,
+    high_value_home: bool,
+    security_system: bool,
+    zip_permille: int = 0,
+) -> tuple:
+    """Compute carrier prices for a bucketed quote.
+    Returns (name, monthly, rating, features, cta) tuples; callers build fresh dicts from them.
+    Prices are computed in integer cents and permille modifiers to avoid float rounding.
+    """
+    base_cents = 60000 if quote_type == "auto" else 120000
+
+    modifier_permille = zip_permille
+    if young_driver:
+        modifier_permille += 250
+    if old_vehicle:
+        modifier_permille += 150
+    if accidents > 0:
+        modifier_permille += min(400, 100 * accidents)
+    if high_value_home:
+        modifier_permille += 200
+    if security_system:
+        modifier_permille -= 50
+
+    # annual cents * (1 + modifier) * factor / 12 months, rounded half-up to the cent
+    numerator = base_cents * (1000 + modifier_permille)
+    divisor = 12 * 1000 * 1000
+    return tuple(
+        (name, (numerator * factor_permille + divisor // 2) // divisor / 100, rating, features, cta)
+        for factor_permille, name, rating, features, cta in _CARRIER_TEMPLATES
+    )
+
+
+# QuoteRequest fields persisted with each quote; unset (None) fields are left out of the document
+_QUOTE_FIELDS = (
+    "quote_type",
+    "zip_code",
+    "age",
+    "vehicle_year",
+    "vehicle_make",
+    "vehicle_model",
+    "accidents_last_5_years",
+    "home_value",
+    "square_feet",
+    "security_system",
+)
+
 
 class QuoteResponse(BaseModel):
     id: str
@@ -42,14 +294,73 @@ class QuoteResponse(BaseModel):
     results: List[Dict[str, Any]]
 
 
+def _make_etag(data: bytes) -> str:
+    # Weak, because GZipMiddleware may send the same content gzip-encoded or as-is
+    return 'W/"%s"' % hashlib.md5(data).hexdigest()
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Check whether the client's If-None-Match header matches the given ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored on both sides
+    etag = _opaque_tag(etag)
+    return any(_opaque_tag(tag.strip()) == etag for tag in if_none_match.split(","))
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+# The root payload never changes, so it is rendered once and reused
+_ROOT_ETAG = '"root-v1"'
+_ROOT_RESPONSE = Response(
+    content=b'{"message":"Insurance Comparison API Running"}',
+    media_type="application/json",
+    headers={"Cache-Control": "public, max-age=3600", "ETag": _ROOT_ETAG},
+)
+
+
 @app.get("/")
-def read_root():
-    return {"message": "Insurance Comparison API Running"}
+async def read_root(request: Request):
+    if _etag_matches(request, _ROOT_ETAG):
+        return _not_modified(_ROOT_ETAG)
+    return _ROOT_RESPONSE
+
+
+# Environment variables don't change at runtime, so resolve them once
+_DATABASE_URL_STATUS = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
+_DATABASE_NAME_STATUS = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+
+_TEST_CACHE_TTL = 5.0  # seconds
+_test_cache = {"time": 0.0, "value": None, "etag": None}
 
 
 @app.get("/test")
-def test_database():
+async def test_database(request: Request, http_response: Response):
     """Test endpoint to check if database is available and accessible"""
+    # Serve the cached diagnostics for a few seconds so frequent probes don't hit the database
+    if _test_cache["value"] is None or time.monotonic() - _test_cache["time"] >= _TEST_CACHE_TTL:
+        response = await _check_database()
+        _test_cache["value"] = response
+        _test_cache["etag"] = _make_etag(orjson.dumps(response, option=orjson.OPT_SORT_KEYS))
+        _test_cache["time"] = time.monotonic()
+
+    etag = _test_cache["etag"]
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    http_response.headers["ETag"] = etag
+    return _test_cache["value"]
+
+
+async def _check_database() -> dict:
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -65,7 +376,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -75,92 +386,131 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    import os as _os
-    response["database_url"] = "✅ Set" if _os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if _os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = _DATABASE_URL_STATUS
+    response["database_name"] = _DATABASE_NAME_STATUS
     return response
 
 
 @app.post("/api/quotes", response_model=QuoteResponse)
-def create_quote(payload: QuoteRequest):
+async def create_quote(payload: QuoteRequest):
     """Create a quote request and return simulated comparison results.
     The request is persisted, and the returned results are embedded for later retrieval.
     """
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    base_price = 600.0 if payload.quote_type == "auto" else 1200.0
-
-    modifiers = 0.0
-    if payload.age and payload.age < 25:
-        modifiers += 0.25
-    if payload.quote_type == "auto":
-        if payload.vehicle_year and payload.vehicle_year < 2005:
-            modifiers += 0.15
-        if (payload.accidents_last_5_years or 0) > 0:
-            modifiers += min(0.4, 0.1 * (payload.accidents_last_5_years or 0))
-    if payload.quote_type == "home":
-        if payload.home_value and payload.home_value > 750000:
-            modifiers += 0.2
-        if payload.security_system:
-            modifiers -= 0.05
+    doc = {}
+    for field in _QUOTE_FIELDS:
+        value = getattr(payload, field)
+        if value is not None:
+            doc[field] = value
 
+    # Bucket the inputs down to the thresholds the pricing rules actually use
+    quote_type = payload.quote_type
+    zip_code = payload.zip_code
+    age = payload.age
+    vehicle_year = payload.vehicle_year
+    accidents = payload.accidents_last_5_years or 0
+    home_value = payload.home_value
+    is_auto = quote_type == "auto"
+    is_home = quote_type == "home"
+    prices = _price(
+        quote_type,
+        bool(age and age < 25),
+        is_auto and bool(vehicle_year and vehicle_year < 2005),
+        min(accidents, 4) if is_auto else 0,
+        is_home and bool(home_value and home_value > 750000),
+        is_home and bool(payload.security_system),
+        _ZIP_FACTOR_PERMILLE.get(zip_code, 0),
+    )
     carriers = [
-        {
-            "name": "BlueShield Mutual",
-            "monthly": round(base_price * (1 + modifiers) / 12 * 0.95, 2),
-            "rating": 4.7,
-            "features": ["24/7 support", "Bundle discount", "Fast claims"],
-            "cta": "Get Started"
-        },
-        {
-            "name": "NorthStar Insurance",
-            "monthly": round(base_price * (1 + modifiers) / 12 * 1.02, 2),
-            "rating": 4.5,
-            "features": ["Accident forgiveness", "Roadside (auto)", "Smart home (home)"],
-            "cta": "Select"
-        },
-        {
-            "name": "Aurora Coverage Co.",
-            "monthly": round(base_price * (1 + modifiers) / 12 * 0.88, 2),
-            "rating": 4.3,
-            "features": ["Low deductible options", "Local agents", "Online portal"],
-            "cta": "View Details"
-        }
+        {"name": name, "monthly": monthly, "rating": rating, "features": list(features), "cta": cta}
+        for name, monthly, rating, features, cta in prices
     ]
 
     # Persist to DB
-    doc = payload.model_dump()
     doc["results"] = carriers
-    from bson import ObjectId
-    collection_name = "quote"
     try:
-        inserted_id = create_document(collection_name, doc)
+        inserted_id = await _persist_quote(doc)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save: {str(e)}")
 
-    return QuoteResponse(
-        id=inserted_id,
-        quote_type=payload.quote_type,
-        zip_code=payload.zip_code,
-        results=carriers
-    )
+    # Returning a response directly skips re-validating this server-built payload against
+    # QuoteResponse; response_model is kept for the OpenAPI docs
+    return MongoJSONResponse({
+        "id": inserted_id,
+        "quote_type": quote_type,
+        "zip_code": zip_code,
+        "results": carriers
+    })
+
+
+async def _stream_items(first_doc, cursor):
+    """Stream a cursor as {"items": [...]} without materializing the documents"""
+    yield b'{"items":['
+    if first_doc is not None:
+        yield orjson.dumps(first_doc, default=_orjson_default)
+        async for doc in cursor:
+            # One chunk per document keeps the ASGI sends (and gzip flushes) to one each
+            yield b"," + orjson.dumps(doc, default=_orjson_default)
+    yield b"]}"
 
 
 @app.get("/api/quotes")
-def list_quotes(limit: int = 20):
+async def list_quotes(
+    request: Request,
+    limit: int = 20,
+    quote_type: Optional[Literal["auto", "home"]] = None,
+    after_id: Optional[str] = None,
+    include_results: bool = False,
+):
+    """List quotes newest first. Pass the last returned _id as after_id to fetch the next page."""
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
+    if after_id is not None and not ObjectId.is_valid(after_id):
+        raise HTTPException(status_code=400, detail="Invalid after_id")
+
+    filter_dict = {"quote_type": quote_type} if quote_type else {}
+    if after_id is not None:
+        filter_dict["_id"] = {"$lt": ObjectId(after_id)}
     try:
-        docs = get_documents("quote", limit=limit)
-        for d in docs:
-            d["_id"] = str(d["_id"])  # make JSON serializable
-        return {"items": docs}
+        # Cheap freshness check against the newest quote before running the full query
+        latest = await db.quote.find_one(filter_dict, {"_id": 1}, sort=[("_id", -1)])
+        latest_id = str(latest["_id"]) if latest else ""
+        etag = _make_etag(f"{latest_id}:{limit}:{quote_type}:{after_id}:{include_results}".encode())
+        if _etag_matches(request, etag):
+            return _not_modified(etag)
+
+        # Keyset pagination on the _id index; carrier results are only shipped on request
+        projection = None if include_results else {"results": 0}
+        cursor = db.quote.find(filter_dict, projection).sort("_id", -1).limit(limit)
+        # Pull the first document (and with it the first batch) before any headers go out,
+        # so query failures still surface as a 500
+        try:
+            first_doc = await cursor.next()
+        except StopAsyncIteration:
+            first_doc = None
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    return StreamingResponse(
+        _stream_items(first_doc, cursor), media_type="application/json", headers={"ETag": etag}
+    )
+
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("UVICORN_WORKERS", os.cpu_count() or 2))
+    # uvloop is not available on Windows; fall back to the stdlib asyncio loop there
+    loop = "uvloop" if sys.platform != "win32" else "asyncio"
+    # workers > 1 requires the app to be passed as an import string
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop=loop,
+        http="httptools",
+        proxy_headers=True,
+    )